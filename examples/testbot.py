@@ -12,8 +12,15 @@ For every received text message, the script logs the (number of messages with
 a supported command in it) / (number of text messages received).
 """
 
+import array
+import functools
 import logging
-import time
+import logging.handlers
+import queue
+import signal
+import struct
+import sys
+import threading
 
 from pubsub import pub
 
@@ -22,19 +29,82 @@ import meshtastic.serial_interface
 
 logger = logging.getLogger(__name__)
 
-rcvd_text_msg_count = 0
-rcvd_command_count = 0
+# Received counts live in one array that is updated in place,
+# so the receive path doesn't rebind module globals
+RCVD_TEXT_MSG, RCVD_COMMAND = 0, 1
+rcvd_counts = array.array("Q", (0, 0))
+
+# Command keywords, matched anywhere in the lowercased message text
+COMMANDS = ("test", "counts")
+# Texts shorter than this can't contain any command
+MIN_CMD_LEN = min(len(cmd) for cmd in COMMANDS)
+
+HELP_REPLY = "Put the word \"test\" in your message and see what happens."
+NO_HOPS_REPLY = "I heard you, but can't count the hops your message took."
+NO_RF_STATS_REPLY = "I heard you, but didn't get any RF stats to share."
+
+# Replies are sent from a background thread, off the receive path
+reply_queue = queue.SimpleQueue()
+
+# Linux struct serial_struct: a buffer big enough for it on 32 and 64-bit
+# hosts, the offset of its int flags field, and the flag that makes
+# USB-serial drivers (e.g. FTDI) pass on received bytes right away
+# instead of holding them for the default 16 ms latency timer
+SERIAL_STRUCT_SIZE = 72
+SERIAL_STRUCT_FLAGS_OFFSET = 16
+ASYNC_LOW_LATENCY = 1 << 13
 
 def main():
-    logging.basicConfig(level=logging.INFO, datefmt="%Y/%m/%d %H:%M%S")
-    pub.subscribe(on_receive, "meshtastic.receive")
-    pub.subscribe(on_connection, "meshtastic.connection.established")
-    with meshtastic.serial_interface.SerialInterface() as _:
-        try:
-            while True:
-                time.sleep(500)
-        finally:
-            logger.info('Finished')
+    log_listener = start_logging()
+    try:
+        pub.subscribe(on_receive, "meshtastic.receive.text")
+        pub.subscribe(on_connection, "meshtastic.connection.established")
+        with meshtastic.serial_interface.SerialInterface() as interface:
+            if sys.platform.startswith("linux"):
+                set_low_latency(interface)
+            threading.Thread(target=send_replies, args=(interface,), daemon=True).start()
+            # Installed only once connected so Ctrl-C can still interrupt
+            # SerialInterface() while it waits for the radio
+            stop_event = threading.Event()
+            signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+            signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+            try:
+                stop_event.wait()
+            finally:
+                logger.info('Finished')
+    finally:
+        # Stopped last so records logged while the interface shuts down,
+        # or when it fails to connect, are still written out
+        log_listener.stop()
+
+def start_logging() -> logging.handlers.QueueListener:
+    """queues log records so the pubsub callbacks don't write them"""
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(
+        logging.Formatter(logging.BASIC_FORMAT, datefmt="%Y/%m/%d %H:%M%S"))
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    log_listener.start()
+    return log_listener
+
+def set_low_latency(interface):
+    """sets ASYNC_LOW_LATENCY on the serial port if its driver allows it"""
+    import fcntl
+    import termios
+
+    try:
+        fd = interface.stream.fileno()
+        serial_info = bytearray(SERIAL_STRUCT_SIZE)
+        fcntl.ioctl(fd, termios.TIOCGSERIAL, serial_info)
+        flags, = struct.unpack_from("i", serial_info, SERIAL_STRUCT_FLAGS_OFFSET)
+        struct.pack_into("i", serial_info, SERIAL_STRUCT_FLAGS_OFFSET,
+                         flags | ASYNC_LOW_LATENCY)
+        fcntl.ioctl(fd, termios.TIOCSSERIAL, serial_info)
+    except (AttributeError, OSError) as e:
+        logger.info('Serial port left at default latency: %s', e)
 
 def on_connection(interface, topic=pub.AUTO_TOPIC):
     """called when we (re)connect to the radio"""
@@ -48,49 +118,65 @@ def on_receive(packet:dict, interface):
     reply = process_received_message(rx_msg)
     if reply:
         origin = rx_msg['from']
-        interface.sendText(reply, destinationId=origin)
-        logger.info(format_counts_reply())
+        reply_queue.put((reply, origin))
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(format_counts_reply())
+
+def send_replies(interface):
+    """sends queued replies so on_receive never waits on the serial port"""
+    while True:
+        reply, origin = reply_queue.get()
+        try:
+            interface.sendText(reply, destinationId=origin)
+        except Exception:
+            logger.exception('Failed to send reply to %s', origin)
 
 def process_received_message(rx_msg:dict) -> str:
-    global rcvd_text_msg_count, rcvd_command_count
-
-    if is_text_message(rx_msg):
-        rcvd_text_msg_count += 1
-        if is_in_message("test", rx_msg):
-            rcvd_command_count += 1
-            return format_test_reply(rx_msg)
-        elif is_in_message("counts", rx_msg):
-            rcvd_command_count += 1
-            return format_counts_reply()
-        return help_reply()
-    return ""
-
-def is_text_message(msg:dict) -> bool:
-    return msg["decoded"]["portnum"] == "TEXT_MESSAGE_APP"
-
-def is_in_message(substr:str, msg:dict) -> bool:
-    return substr in msg["decoded"]["text"].lower()
+    # on_receive is subscribed to text messages only, but meshtastic still
+    # publishes one whose payload failed to decode as UTF-8, without "text"
+    text = rx_msg["decoded"].get("text")
+    if text is None:
+        return ""
+    rcvd_counts[RCVD_TEXT_MSG] += 1
+    if len(text) < MIN_CMD_LEN:
+        return HELP_REPLY
+    text_lc = text.lower()
+    if "test" in text_lc:
+        rcvd_counts[RCVD_COMMAND] += 1
+        return format_test_reply(rx_msg)
+    elif "counts" in text_lc:
+        rcvd_counts[RCVD_COMMAND] += 1
+        return format_counts_reply()
+    return HELP_REPLY
 
 def format_test_reply(msg:dict) -> str:
-    msg_keys = msg.keys()
-    if "hopStart" not in msg_keys or "hopLimit" not in msg_keys:
-        return "I heard you, but can't count the hops your message took."
-    else:
-        intermediate_node_count = msg['hopStart'] - msg['hopLimit']
-        if intermediate_node_count == 0:
-            if "rxSnr" not in msg_keys or "rxRssi" not in msg_keys:
-                return "I heard you, but didn't get any RF stats to share."
-            else:
-                return f"I heard you!\nSNR: {msg['rxSnr']}, RSSI: {msg['rxRssi']}"
-        else:
-            return f"I heard you!\nthrough {intermediate_node_count} nodes."
+    hop_start = msg.get('hopStart')
+    hop_limit = msg.get('hopLimit')
+    if hop_start is None or hop_limit is None:
+        return NO_HOPS_REPLY
+    intermediate_node_count = hop_start - hop_limit
+    if intermediate_node_count:
+        return f"I heard you!\nthrough {intermediate_node_count} nodes."
+    rx_snr = msg.get('rxSnr')
+    rx_rssi = msg.get('rxRssi')
+    if rx_snr is None or rx_rssi is None:
+        return NO_RF_STATS_REPLY
+    return format_rf_stats_reply(rx_snr, rx_rssi)
+
+# Nodes that test repeatedly tend to report the same RF stats,
+# so the reply for each recent (SNR, RSSI) pair is kept
+@functools.lru_cache(maxsize=128, typed=True)
+def format_rf_stats_reply(rx_snr:float, rx_rssi:int) -> str:
+    return f"I heard you!\nSNR: {rx_snr}, RSSI: {rx_rssi}"
 
 def format_counts_reply() -> str:
-    global rcvd_text_msg_count, rcvd_command_count
-    return f"{rcvd_command_count}/{rcvd_text_msg_count}"
+    return format_counts(rcvd_counts[RCVD_COMMAND], rcvd_counts[RCVD_TEXT_MSG])
 
-def help_reply():
-    return "Put the word \"test\" in your message and see what happens."
+# The counts are formatted for both the "counts" reply and the log line
+# that follows it, so the last result is kept
+@functools.lru_cache(maxsize=1)
+def format_counts(command_count:int, text_msg_count:int) -> str:
+    return f"{command_count}/{text_msg_count}"
 
 if __name__ == "__main__":
     main()